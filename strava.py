@@ -8,13 +8,32 @@ import json
 import math
 import sys
 import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from PIL import Image, ImageDraw
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from PIL import Image
 import numpy as np
-import xml.etree.ElementTree as ET
-from shapely.geometry.polygon import Polygon
+import cv2
+from scipy import ndimage
+import shapely
 from shapely.geometry import shape, GeometryCollection
 import sqlite3
+try:
+    from numba import njit
+except ImportError:     # numba is optional, the functions are then interpreted
+    def njit(*args, **kwargs):
+        return lambda function: function
+
+# Local references to the math functions used by the scalar projection routines
+_radians = math.radians
+_degrees = math.degrees
+_tan = math.tan
+_atan = math.atan
+_asinh = math.asinh
+_exp = math.exp
+_pi = math.pi
 
 
 def print_debug(*args):
@@ -28,66 +47,85 @@ def print_verbose(*args):
 
 
 # Convert geographical coordinates to tile number
+@njit(cache=True)
 def deg2num(lat_deg, lon_deg, zoom):
-    lat_rad = math.radians(lat_deg)
+    lat_rad = _radians(lat_deg)
     n = 1 << zoom
     xtile = int((lon_deg + 180.0) / 360.0 * n)
-    ytile = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    ytile = int((1.0 - _asinh(_tan(lat_rad)) / _pi) / 2.0 * n)
     return xtile, ytile
 
 
-# Convert tile number to geographical coordinates
-def num2deg(xtile, ytile, zoom):
+# Convert arrays of tile numbers to geographical coordinates
+def num2deg_vec(xtile, ytile, zoom):
     n = 1 << zoom
     lon_deg = xtile / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * ytile / n)))
-    lat_deg = math.degrees(lat_rad)
+    lat_deg = np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * ytile / n))))
     return lat_deg, lon_deg
 
 
 RADIUS = 6378137.0  # in meters on the equator
 
+CACHE_DIR = '/var/cache/strava'
 
-# Convert latitude to northing (Pseudo-Mercator projection)
-def lat2y(lat):
-    return math.log(math.tan(math.pi / 4 + math.radians(lat) / 2)) * RADIUS
+# HTTP sessions keeping the connections to the servers alive between tiles
+strava_session = requests.Session()
+strava_session.headers['User-Agent'] = ('Mozilla/5.0 (X11; Linux x86_64; rv:123.0) '
+                                        'Gecko/20100101 Firefox/123.0')
+strava_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                             max_retries=Retry(total=5, backoff_factor=1)))
+overpass_session = requests.Session()
+overpass_session.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                               max_retries=Retry(total=5, backoff_factor=1,
+                                                                 status_forcelist=[429, 504])))
 
+# Locks shared by the threads processing the Strava tiles
+output_lock = threading.Lock()
+cache_lock = threading.Lock()
+# The Overpass server only accepts a couple of simultaneous queries from the same address
+overpass_semaphore = threading.Semaphore(2)
 
-# Convert longitude to easting (Pseudo-Mercator projection)
-def lon2x(lon):
-    return math.radians(lon) * RADIUS
+
+# Convert an array of latitudes to northings (Pseudo-Mercator projection)
+def lat2y_vec(lat):
+    return np.log(np.tan(np.pi / 4 + np.radians(lat) / 2)) * RADIUS
+
+
+# Convert an array of longitudes to eastings (Pseudo-Mercator projection)
+def lon2x_vec(lon):
+    return np.radians(lon) * RADIUS
 
 
 # Convert northing (Pseudo-Mercator projection) to latitude
+@njit(cache=True)
 def y2lat(y):
-    return math.degrees(2 * math.atan(math.exp(y / RADIUS)) - math.pi / 2.0)
+    return _degrees(2 * _atan(_exp(y / RADIUS)) - _pi / 2.0)
 
 
 # Convert easting (Pseudo-Mercator projection) to longitude
+@njit(cache=True)
 def x2lon(x):
-    return math.degrees(x / RADIUS)
+    return _degrees(x / RADIUS)
 
 
-# Get bounding box of a Strava tile in geographical coordinates
-def get_geo_bbox(x, y, zoom):
-    (lat_ul, lon_ul) = num2deg(x, y, zoom)
-    (lat_lr, lon_lr) = num2deg(x + 1, y + 1, zoom)
-    return lat_ul, lon_ul, lat_lr, lon_lr
+# Get pseudo-Mercator coordinates of the edges of all the Strava tiles at a zoom level
+def get_merc_edges(zoom):
+    tiles = np.arange((1 << zoom) + 1)
+    (lat_deg, lon_deg) = num2deg_vec(tiles, tiles, zoom)
+    return lon2x_vec(lon_deg), lat2y_vec(lat_deg)
 
 
-# Get bounding box of a Strava tile in pseudo-Mercator coordinates
-def get_merc_bbox(x, y, zoom):
-    (lat_ul, lon_ul, lat_lr, lon_lr) = get_geo_bbox(x, y, zoom)
-    return lat2y(lat_ul), lon2x(lon_ul), lat2y(lat_lr), lon2x(lon_lr)
+# Get bounding box of a Strava tile in pseudo-Mercator coordinates (at the zoom level of the tables)
+def get_merc_bbox(x, y):
+    return edges_y_merc[y], edges_x_merc[x], edges_y_merc[y + 1], edges_x_merc[x + 1]
 
 
 # Transforms projected coordinates to image coordinates
 def transform(coords_merc, bbox_merc, pixel_size):
-    transformed = []
-    for coord in coords_merc:
-        transformed.append((round((coord[0] - bbox_merc[1]) / pixel_size),
-                            round((bbox_merc[0] - coord[1]) / pixel_size)))
-    return transformed
+    coords = np.empty(coords_merc.shape, dtype=np.int32)     # Contiguous, as expected by OpenCV
+    coords[:, 0] = np.rint((coords_merc[:, 0] - bbox_merc[1]) / pixel_size)
+    coords[:, 1] = np.rint((bbox_merc[0] - coords_merc[:, 1]) / pixel_size)
+    return coords
 
 
 # Transforms image coordinates to projected coordinates
@@ -96,85 +134,158 @@ def reverse_transform(coords, bbox_merc, pixel_size):
             y2lat(bbox_merc[0] - coords[0] * pixel_size))
 
 
-# Plot a black line on the image
-def plot_line(draw, coords_merc, bbox, w, pixel_size):
-    draw.line(transform(coords_merc, bbox, pixel_size), fill=0, width=w)
-
-
-# Plot a polygon on the image
-def plot_polygon(draw, coords_merc, bbox, pixel_size):
-    draw.polygon(transform(coords_merc, bbox, pixel_size), outline=0, fill=0)
-
-
-# Plot a circle on the image
-def plot_circle(draw, center_merc, bbox, diameter, pixel_size):
-    radius = diameter / 2
-    centers = transform(center_merc, bbox, pixel_size)
-    for center in centers:
-        bbox = [center[0] - radius, center[1] - radius, center[0] + radius, center[1] + radius]
-        draw.ellipse(bbox, fill=0)
-
-
-# Recursive routine to measure the area of the trace on heatmap
-def check_trace_area(image, row, col, target_color, min_size, size):
-    # Check if the current pixel is within the image boundaries
-    if row < 0 or row >= len(image) or col < 0 or col >= len(image[0]):
-        return size
-
-    # Check if the color of the current pixel matches the target color
-    if image[row][col] < target_color:
-        return size
-
-    # Change the color of the current pixel to the replacement color
-    image[row][col] = 0
-    size = size + 1
-    if size > min_size:   # To avoid stack overflow
-        return size
-
-    # Recursively call check_trace_area on adjacent pixels
-    size = check_trace_area(image, row + 1, col, target_color, min_size, size)  # Down
-    size = check_trace_area(image, row - 1, col, target_color, min_size, size)  # Up
-    size = check_trace_area(image, row, col + 1, target_color, min_size, size)  # Right
-    size = check_trace_area(image, row, col - 1, target_color, min_size, size)  # Left
-    return size
+# Path of the NumPy copy of a Strava tile in cache
+def get_array_path(strava_tile):
+    return os.path.splitext(strava_tile)[0] + '.npy'
+
+
+# Path of a Strava tile in cache
+def get_cache_path(zoom, x, y):
+    return os.path.join(CACHE_DIR, activity, str(zoom), str(x), str(y) + '.png')
+
+
+# Open the index of the Strava tiles in cache, used to evict the least recently used ones
+def open_cache_index():
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    con = sqlite3.connect(os.path.join(CACHE_DIR, 'cache.db'), check_same_thread=False)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")    # No sync on each commit in WAL mode
+    con.execute("CREATE TABLE IF NOT EXISTS tiles "
+                "(path TEXT PRIMARY KEY, size INTEGER, atime REAL, expires REAL)")
+    return con
+
+
+# Record a Strava tile written in cache, with its expiration time from the HTTP headers
+def index_cache_tile(path, headers):
+    if cache_index is None:
+        return
+    expires = None
+    for directive in headers.get('Cache-Control', '').split(','):
+        (name, _, value) = directive.strip().partition('=')
+        if name == 'max-age' and value.isdigit():
+            expires = time.time() + int(value)
+    with cache_lock, cache_index:
+        cache_index.execute("INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)",
+                            (path, os.path.getsize(path), time.time(), expires))
+
+
+# Get the expiration time of a Strava tile in cache
+def get_cache_expiry(path):
+    if cache_index is None:
+        return None
+    with cache_lock:
+        row = cache_index.execute("SELECT expires FROM tiles WHERE path=?", (path,)).fetchone()
+    return None if row is None else row[0]
+
+
+# Record the access to the Strava tiles of a block in one transaction, with their current size
+def touch_cache_tiles(paths):
+    if cache_index is None:
+        return
+    now = time.time()
+    rows = []
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        size = os.path.getsize(path)
+        array_path = get_array_path(path)
+        if os.path.isfile(array_path):
+            size += os.path.getsize(array_path)
+        rows.append((path, size, now))
+    # Tiles in cache before the index was created are added on their first access
+    with cache_lock, cache_index:
+        cache_index.executemany("INSERT INTO tiles VALUES (?, ?, ?, NULL) ON CONFLICT(path) "
+                                "DO UPDATE SET size=excluded.size, atime=excluded.atime", rows)
+
+
+# Delete the least recently used Strava tiles until the cache is below its maximum size
+def evict_cache(max_size):
+    with cache_lock, cache_index:
+        total_size = cache_index.execute("SELECT COALESCE(SUM(size), 0) FROM tiles").fetchone()[0]
+        if total_size <= max_size:
+            return
+        print_verbose("Cache size =", total_size)
+        for (path, size) in cache_index.execute("SELECT path, size FROM tiles ORDER BY atime").fetchall():
+            if total_size <= max_size:
+                break
+            for file_path in (path, get_array_path(path)):
+                if os.path.isfile(file_path):
+                    os.remove(file_path)
+            cache_index.execute("DELETE FROM tiles WHERE path=?", (path,))
+            total_size -= size
 
 
 # Check if Strava file is available in cache and download it if not in cache
 def fetch_strava_tile(zoom, x, y):
-    cache_dir = '/var/cache/strava'
-    cache_file_path = os.path.join(cache_dir, activity, str(zoom), str(x), str(y) + '.png')
+    cache_file_path = get_cache_path(zoom, x, y)
+    expired = False
     if os.path.isfile(cache_file_path):
-        if os.path.getsize(cache_file_path) > 0:
+        expires = get_cache_expiry(cache_file_path)
+        if expires is not None and expires < time.time():
+            print_verbose("Expired tile in cache:", cache_file_path)
+            expired = True
+        elif os.path.getsize(cache_file_path) > 0:
             print_verbose("Tile in cache:", cache_file_path)
             return cache_file_path
         else:
             print_verbose("Empty tile in cache :", cache_file_path)
             return None
-    dir1 = os.path.join(cache_dir, activity, str(zoom))
-    if not os.path.isdir(dir1):
-        os.makedirs(dir1, exist_ok=True)
-    dir2 = os.path.join(dir1, str(x))
-    if not os.path.isdir(dir2):
-        os.mkdir(dir2)
+    # Several threads may create the same directory at the same time
+    os.makedirs(os.path.dirname(cache_file_path), exist_ok=True)
 
     url = f'https://strava-heatmap.tiles.freemap.sk/{activity}/hot/{zoom}/{x}/{y}.png'
     print_verbose("Downloading Strava tile at", url)
     try:
-        r = requests.get(url, allow_redirects=True, headers={'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:123.0) Gecko/20100101 Firefox/123.0'})
+        r = strava_session.get(url, allow_redirects=True, timeout=60)
         r.raise_for_status()
     except requests.exceptions.HTTPError as e:
         print_debug("Status code =", e.response.status_code)
         if e.response.status_code == 404:
-            open(cache_file_path, 'wb').write(r.content)    # Write an empty file
-        else:
-            print(e, file=sys.stderr)
-        cache_file_path = None
+            write_strava_tile(cache_file_path, r)   # Write an empty file
+            return None
+        print(e, file=sys.stderr)
     except requests.exceptions.RequestException as e:
         print(e, file=sys.stderr)
-        cache_file_path = None
     else:
-        open(cache_file_path, 'wb').write(r.content)
-    return cache_file_path
+        write_strava_tile(cache_file_path, r)
+        return cache_file_path
+    # Use the expired tile still in cache if it cannot be downloaded again
+    if expired and os.path.getsize(cache_file_path) > 0:
+        return cache_file_path
+    return None
+
+
+# Write a downloaded Strava tile in cache, replacing its previous version
+def write_strava_tile(cache_file_path, r):
+    if os.path.isfile(get_array_path(cache_file_path)):
+        os.remove(get_array_path(cache_file_path))
+    open(cache_file_path, 'wb').write(r.content)
+    index_cache_tile(cache_file_path, r.headers)
+
+
+# Load a Strava tile as an array, from its NumPy copy in cache if available
+def load_strava_tile(strava_tile):
+    array_path = get_array_path(strava_tile)
+    if os.path.isfile(array_path):
+        return np.load(array_path)
+    image = Image.open(strava_tile)
+    if image.mode == 'P':
+        data = np.array(image)      # The palette indexes are the levels of the heatmap
+    elif image.mode == 'L':
+        data = cv2.imread(strava_tile, cv2.IMREAD_GRAYSCALE)     # Decoded directly to an array
+    else:
+        data = np.array(image.convert('L'))
+    return data
+
+
+# Save a NumPy copy of a Strava tile in cache, to avoid decoding the PNG file next time
+def save_strava_tile_array(strava_tile, data):
+    array_path = get_array_path(strava_tile)
+    if os.path.isfile(array_path):
+        return
+    with open(array_path + '.tmp', 'wb') as f:
+        np.save(f, data)
+    os.replace(array_path + '.tmp', array_path)
 
 
 # Overpass request to download OSM ways in a bbox
@@ -185,7 +296,7 @@ def overpass_request(lat_ul_merc, lon_ul_merc, lat_lr_merc, lon_lr_merc):
     lon_lr = x2lon(lon_lr_merc)
 
     url = "https://overpass-api.de/api/interpreter?data=" + requests.utils.quote(
-        f'[bbox:{lat_lr},{lon_ul},{lat_ul},{lon_lr}];'
+        f'[out:json][bbox:{lat_lr},{lon_ul},{lat_ul},{lon_lr}];'
         '(nwr[highway~"bridleway|corridor|crossing|cycleway|escape|footway|living_street|motorway|'
         'motorway_link|path|pedestrian|primary|primary_link|raceway|residential|road|secondary|'
         'secondary_link|service|steps|tertiary|tertiary_link|track|trunk|trunk_link|unclassified"];'
@@ -200,181 +311,250 @@ def overpass_request(lat_ul_merc, lon_ul_merc, lat_lr_merc, lon_lr_merc):
         'nwr[route=ferry];);out geom;')
 
     for retries in range(10):
-        r = requests.get(url, allow_redirects=True, stream=True)
-        osm_root = ET.fromstring(r.content)
-        if osm_root.find('meta') is not None:   # Check that the result is not empty
-            return osm_root
+        try:
+            with overpass_semaphore:
+                r = overpass_session.get(url, allow_redirects=True, timeout=300)
+            osm_data = json.loads(r.content)
+        except requests.exceptions.RequestException as e:   # Retries exhausted or timeout
+            print_verbose(e)
+            osm_data = {}
+        except ValueError:      # Error message instead of a JSON result
+            osm_data = {}
+        # Check that the result is not empty, nor cut by a timeout or memory error of the server
+        if 'osm3s' in osm_data and 'runtime error' not in osm_data.get('remark', ''):
+            return osm_data
         time.sleep(5)
     else:
         print("No answer from Overpass server")
         sys.exit(1)
 
 
-# Draw the OSM ways with black color on the Strava image
-def plot_ways(osm_root, draw, width, pixel_size):
-    for way in osm_root.iter('way'):
+# Get the node lists of the OSM ways and relations, and if they are areas
+def get_osm_features(osm_data):
+    geometries = []
+    areas = []
+    for way in osm_data['elements']:
+        if way['type'] != 'way':
+            continue
         area = False
-        coords = []
-        for tag in way.iter('tag'):
-            if (tag.attrib["k"] == "area" and tag.attrib["v"] == "yes") or \
-               tag.attrib["k"] .startswith("area:") or \
-               (tag.attrib["k"] == "leisure" and tag.attrib["v"] != "track"):
+        for (k, v) in way.get('tags', {}).items():
+            if (k == "area" and v == "yes") or k.startswith("area:") or \
+               (k == "leisure" and v != "track"):
                 area = True
-            if tag.attrib["k"] == "area" and tag.attrib["v"] == "no":
+            if k == "area" and v == "no":
                 area = False
-        for node in way.iter('nd'):
-            coords.append((lon2x(float(node.attrib["lon"])), lat2y(float(node.attrib["lat"]))))
-        if area:
-            plot_polygon(draw, coords, get_merc_bbox(x, y, zoom), pixel_size)
-        plot_line(draw, coords, get_merc_bbox(x, y, zoom), width, pixel_size)
-        plot_circle(draw, coords, get_merc_bbox(x, y, zoom), width, pixel_size)
-
+        geometries.append(way['geometry'])
+        areas.append(area)
 
-# Draw the OSM relations with black color on the Strava image
-# -----------------------------------------------------------
-
-
-def plot_relations(osm_root, draw, width, pixel_size):
-    for relation in osm_root.iter('relation'):
+    for relation in osm_data['elements']:
+        if relation['type'] != 'relation':
+            continue
         area = False
-        for tag in relation.iter('tag'):
-            if (tag.attrib["k"] == "area" and tag.attrib["v"] == "yes") or \
-               tag.attrib["k"] .startswith("area:") or \
-               (tag.attrib["k"] == "leisure" and tag.attrib["v"] != "track"):
+        for (k, v) in relation.get('tags', {}).items():
+            if (k == "area" and v == "yes") or k.startswith("area:") or \
+               (k == "leisure" and v != "track"):
                 area = True
-            if tag.attrib["k"] == "type" and tag.attrib["v"] == "multipolygon":
+            if k == "type" and v == "multipolygon":
                 area = True
-            if tag.attrib["k"] == "area" and tag.attrib["v"] == "no":
+            if k == "area" and v == "no":
                 area = False
-        member_coords = []
-        for member in relation.iter('member'):
-            if member.attrib['type'] == 'way' and member.attrib['role'] == 'outer':
-                member_coords.append([])
-                for node in member.iter('nd'):
-                    member_coords[-1].append((lon2x(float(node.attrib["lon"])),
-                                             lat2y(float(node.attrib["lat"]))))
         if area:
-            polygons = []
-            while len(member_coords) > 0:
-                coords = member_coords.pop(0)
-                while coords[0] != coords[-1]:
-                    for coord in member_coords:
-                        if coords[-1] == coord[0]:
-                            member_coords.remove(coord)
-                            coords = coords + coord    # Merge lists
+            member_nodes = [member['geometry'] for member in relation['members']
+                            if member['type'] == 'way' and member['role'] == 'outer' and
+                            len(member.get('geometry', [])) > 0]
+            while len(member_nodes) > 0:
+                nodes = member_nodes.pop(0)
+                while nodes[0] != nodes[-1]:
+                    for member in member_nodes:
+                        if nodes[-1] == member[0]:
+                            member_nodes.remove(member)
+                            nodes = nodes + member          # Merge lists
                             break
-                        elif coords[-1] == coord[-1]:
-                            member_coords.remove(coord)
-                            coord.reverse()
-                            coords = coords + coord    # Merge lists
+                        elif nodes[-1] == member[-1]:
+                            member_nodes.remove(member)
+                            nodes = nodes + member[::-1]    # Merge lists
                             break
-                polygons.append(coords)
-
-            for coords in polygons:
-                plot_polygon(draw, coords, get_merc_bbox(x, y, zoom), pixel_size)
-                plot_line(draw, coords, get_merc_bbox(x, y, zoom), width, pixel_size)
-                plot_circle(draw, coords, get_merc_bbox(x, y, zoom), width, pixel_size)
+                    else:
+                        break   # The polygon cannot be closed
+                geometries.append(nodes)
+                areas.append(True)
         else:
-            for member in relation.iter('member'):
-                if member.attrib['type'] == 'way':
-                    member_coords = []
-                    for node in member.iter('nd'):
-                        member_coords.append((lon2x(float(node.attrib["lon"])),
-                                             lat2y(float(node.attrib["lat"]))))
-                    plot_line(draw, member_coords, get_merc_bbox(x, y, zoom), width, pixel_size)
-                    plot_circle(draw, member_coords, get_merc_bbox(x, y, zoom),
-                                width, pixel_size)
+            for member in relation['members']:
+                if member['type'] == 'way':
+                    geometries.append(member.get('geometry', []))
+                    areas.append(False)
+    return geometries, areas
+
+
+# Project the nodes of all the OSM features at once (Pseudo-Mercator projection).
+# The features are stored as a single array of coordinates, and the offsets of the
+# first node of each feature in this array.
+def project_features(geometries, areas):
+    offsets = np.zeros(len(geometries) + 1, dtype=np.intp)
+    np.cumsum([len(nodes) for nodes in geometries], out=offsets[1:])
+    coords_merc = np.empty((offsets[-1], 2))
+    coords_merc[:, 0] = lon2x_vec(np.fromiter((node["lon"] for nodes in geometries for node in nodes),
+                                              dtype=float, count=offsets[-1]))
+    coords_merc[:, 1] = lat2y_vec(np.fromiter((node["lat"] for nodes in geometries for node in nodes),
+                                              dtype=float, count=offsets[-1]))
+    return coords_merc, offsets, np.array(areas, dtype=bool)
+
+
+# Draw the OSM features with black color on the Strava image
+def plot_features(data, features_merc, bbox_merc, width, pixel_size):
+    (coords_merc, offsets, areas) = features_merc
+    coords_px = transform(coords_merc, bbox_merc, pixel_size)
+    lines = [coords_px[start:end] for (start, end) in zip(offsets[:-1], offsets[1:])]
+    for i in np.flatnonzero(areas):
+        # Areas are filled one by one, as overlapping polygons would be xored
+        cv2.fillPoly(data, [lines[i]], 0)
+    # Thick lines are drawn with round ends, so no circle is needed at each node.
+    # OpenCV lines are one pixel wider on each side than the requested thickness,
+    # except for a thickness of 1 or 2 (1 and 3 pixels wide).
+    cv2.polylines(data, lines, isClosed=False, color=0, thickness=max(width - 2, (width + 1) // 2))
+    # OpenCV draws nothing for a line with a single node
+    for i in np.flatnonzero(np.diff(offsets) == 1):
+        cv2.circle(data, (int(lines[i][0][0]), int(lines[i][0][1])), width // 2, 0, -1)
+
 
 # This routine check if a strava heatmap tile contains a way not in OSM
 # ---------------------------------------------------------------------
-def check_strava_tile(polygon_area, x, y, zoom):
-    # Get bounding box of strava tile in geographical coordinates
-    (lat_ul, lon_ul, lat_lr, lon_lr) = get_geo_bbox(x, y, zoom)
+def check_strava_tile(x, y, zoom, strava_tile, data, features_merc):
+#        if debug:
+#            # Fill with white pixels to display the mask
+#            data.fill(255)
 
-    # Create a polygon for the bounding box
-    polygon_strava = Polygon(((lon_ul, lat_ul), (lon_lr, lat_ul),
-                             (lon_lr, lat_lr), (lon_ul, lat_lr), (lon_ul, lat_ul)))
+    # Get bounding box of strava tile in Mercator coordinates
+    bbox_merc = get_merc_bbox(x, y)
+    pixel_size = (bbox_merc[0] - bbox_merc[2]) / data.shape[1]
+    print_debug("Pixel size =", pixel_size)
+    width = round(distance / pixel_size) * 2 + 1
+    print_debug("Line width =", width)
 
-    # Checks if the tile is in the area
-    if polygon_area is None or polygon_strava.intersects(polygon_area):
+    # Plot OSM features on the Strava tile with black color
+    plot_features(data, features_merc, bbox_merc, width, pixel_size)
+
+    if debug:
+        debug_image = Image.fromarray(data)
+        palette = Image.open(strava_tile).getpalette()
+        if palette is not None:
+            debug_image.putpalette(palette)
+        debug_image.save(f"test_{zoom}_{x}_{y}.png")  # For debugging
+
+    # Check if a pixel is still above the threshold, with a single pass on the tile
+    (_, maximum, _, _) = cv2.minMaxLoc(data)
+    if maximum < threshold:
+        return
+
+    # Label the traces above the threshold
+    traces, count = ndimage.label(data >= threshold)
+    flat_traces = traces.ravel()
+    pixels = np.flatnonzero(flat_traces)    # Only the pixels of the traces are looked at below
+    sizes = np.bincount(flat_traces[pixels], minlength=count + 1)
+
+    # Only the traces larger than the min size can be issues
+    large = sizes > min_size
+    large[0] = False
+    if not np.any(large):
+        return
+    pixels = pixels[large[flat_traces[pixels]]]
+    maximums = np.zeros(count + 1, dtype=int)
+    maximums[large] = ndimage.maximum(data, traces, np.flatnonzero(large))
+    # Position of the first lighter pixel of each large trace
+    lighter = pixels[data.ravel()[pixels] == maximums[flat_traces[pixels]]]
+    labels, first = np.unique(flat_traces[lighter], return_index=True)
+    flat_positions = lighter[first]
+    positions = list(zip(*np.unravel_index(flat_positions, data.shape)))
+    sizes = sizes[labels]
+    maximums = maximums[labels]
+
+    # Label the non black areas containing the traces, to report a single issue per area
+    if len(labels) > 1:
+        areas, _ = ndimage.label(data > 0)
+    else:
+        areas = traces      # A single trace is alone in its area
+
+    # Loop on the traces from the lighter to the darker one
+    cleared_areas = set()
+    for i in np.lexsort((flat_positions, -maximums)):
+        maximum = maximums[i]
+        max_index = positions[i]
+        size = sizes[i]
+        # Skip the traces in an area where an issue has already been found
+        if areas[max_index] in cleared_areas:
+            continue
+        result = reverse_transform(max_index, bbox_merc, pixel_size)
+        # print(f"geo:{result[1]},{result[0]}?z={zoom}")
+        print_verbose(f"https://www.openstreetmap.org/?mlat={result[1]}&"
+                      f"mlon={result[0]}#map={zoom}/{result[1]}/{result[0]}&layers=N")
+
+        id = f"{zoom}/{x}/{y}/{max_index[0]}/{max_index[1]}"   # Unique ID for the MR task
+        status = ""
+        # Check if this task has already been processed
+        res = tasks.get(id)
+        if res is not None:
+            status = res[0]
+            print_verbose(status, ":", res[2][21:-2])
+
+        if status == "Fixed" or status == "Already_Fixed":
+            print(f"Warning: This task has been marked as fixed by {res[1]},"
+                  f" but it seems it is not: {res[2][21:-2]}/inspect", file=sys.stderr)
+
+        if status != "Too_Hard" and status != "Not_an_Issue":
+            # print GEOJSON line for MapRoulette
+            RS = chr(30)  # Record Separator ASCII control character
+            with output_lock:
+                print(f'{RS}{{"type":"FeatureCollection","features":[{{"type":"Feature",'
+                      f'"geometry":{{"type":"Point","coordinates":[{result[0]}, {result[1]}]}},'
+                      f'"properties":{{"id":"{id}","latitude":"{result[0]}",'
+                      f'"longitude":"{result[1]}","distance":"{distance}",'
+                      f'"threshold":"{threshold}","maximum":"{maximum}",'
+                      f'"min_size":"{min_size}","size":"{size}"}}}}],'
+                      f'"id":"{id}"}}', file=geojson_file)
+
+        # Disable the area of the issue that has been found
+        print_debug(x, y, max_index, maximum)
+        cleared_areas.add(areas[max_index])
+
+
+# This routine check the Strava heatmap tiles of a block with a single Overpass request
+# ------------------------------------------------------------------------------------
+def check_strava_block(tiles, zoom):
+    strava_tiles = []
+    for (x, y) in tiles:
+        print_debug(x, y)
         strava_tile = fetch_strava_tile(zoom, x, y)         # Get Strava tile
         if strava_tile is None:
-            return
+            continue
         try:
-            image = Image.open(strava_tile)
+            data = load_strava_tile(strava_tile)
         except Exception:
             print(f"Warning: Invalid Strava tile {strava_tile}", file=sys.stderr)
-            return
-        draw = ImageDraw.Draw(image)
+            continue
+        # Skip the tile before any drawing or Overpass request if no pixel is above the threshold
+        (_, maximum, _, _) = cv2.minMaxLoc(data)
+        if maximum >= threshold:
+            # Only the tiles processed again on the next run are worth a NumPy copy (256 KB)
+            save_strava_tile_array(strava_tile, data)
+            strava_tiles.append((x, y, strava_tile, data))
+        else:
+            print_debug("No pixel above the threshold in tile", x, y)
+    touch_cache_tiles([get_cache_path(zoom, x, y) for (x, y) in tiles])
+    if len(strava_tiles) == 0:
+        return
 
-#        if debug:
-#            # Fill with white pixels to display the mask
-#            draw.rectangle((0,0,511,511), fill=255, outline=255)
-
-        # Get bounding box of strava tile in Mercator coordinates
-        (lat_ul_merc, lon_ul_merc, lat_lr_merc, lon_lr_merc) = get_merc_bbox(x, y, zoom)
-        pixel_size = (lat_ul_merc - lat_lr_merc) / image.size[0]
-        print_debug("Pixel size =", pixel_size)
-        width = round(distance / pixel_size) * 2 + 1
-        print_debug("Line width =", width)
-
-        # Overpass request to get all OSM ways in the Strava tile bounding box
-        osm_root = overpass_request(lat_ul_merc + distance, lon_ul_merc - distance,
-                                    lat_lr_merc - distance, lon_lr_merc + distance)
-
-        # Plot OSM features on the Strava tile with black color
-        plot_ways(osm_root, draw, width, pixel_size)
-        plot_relations(osm_root, draw, width, pixel_size)
-
-        if debug:
-            image.save(f"test_{zoom}_{x}_{y}.png")  # For debugging
-
-        data = np.array(image)
-        # Loop while the lighter pixel in the Strava tile is above the threshold
-        while np.max(data) >= threshold:
-            maximum = np.max(data)
-            max_index = np.unravel_index(np.argmax(data), data.shape)
-            result = reverse_transform(max_index, get_merc_bbox(x, y, zoom), pixel_size)
-            size = 0
-            size = check_trace_area(data, max_index[0], max_index[1], threshold, min_size, size)
-            if size > min_size:             # Is the size of the trace larger than the min size ?
-                # print(f"geo:{result[1]},{result[0]}?z={zoom}")
-                print_verbose(f"https://www.openstreetmap.org/?mlat={result[1]}&"
-                              f"mlon={result[0]}#map={zoom}/{result[1]}/{result[0]}&layers=N")
-
-                id = f"{zoom}/{x}/{y}/{max_index[0]}/{max_index[1]}"   # Unique ID for the MR task
-                status = ""
-                if tasks_db is not None:
-                    # Check if this task has already been processed
-                    res = cur.execute("SELECT TaskStatus,Mapper,TaskLink FROM tasks "
-                                      f"WHERE TaskName='{id}'").fetchone()
-                    if res is not None:
-                        status = res[0]
-                        print_verbose(status, ":", res[2][21:-2])
-
-                if status == "Fixed" or status == "Already_Fixed":
-                    print(f"Warning: This task has been marked as fixed by {res[1]},"
-                          f" but it seems it is not: {res[2][21:-2]}/inspect", file=sys.stderr)
-
-                if status != "Too_Hard" and status != "Not_an_Issue":
-                    # print GEOJSON line for MapRoulette
-                    RS = chr(30)  # Record Separator ASCII control character
-                    print(f'{RS}{{"type":"FeatureCollection","features":[{{"type":"Feature",'
-                          f'"geometry":{{"type":"Point","coordinates":[{result[0]}, {result[1]}]}},'
-                          f'"properties":{{"id":"{id}","latitude":"{result[0]}",'
-                          f'"longitude":"{result[1]}","distance":"{distance}",'
-                          f'"threshold":"{threshold}","maximum":"{maximum}",'
-                          f'"min_size":"{min_size}","size":"{size}"}}}}],'
-                          f'"id":"{id}"}}', file=geojson_file)
-
-                # Flood fill to disable the area of the issue that has been found
-                if debug:
-                    image.save(f"before_flood_{zoom}_{x}_{y}.png")  # For debugging
-                print_debug(x, y, max_index, maximum)
-                ImageDraw.floodfill(image, (max_index[1], max_index[0]), 0, thresh=maximum - 1)
-                data = np.array(image)
-                if debug:
-                    image.save(f"after_flood_{zoom}_{x}_{y}.png")  # For debugging
+    # Overpass request to get all OSM ways in the bounding box of the Strava tiles
+    (lat_ul_merc, lon_ul_merc, _, _) = get_merc_bbox(min(tile[0] for tile in strava_tiles),
+                                                     min(tile[1] for tile in strava_tiles))
+    (_, _, lat_lr_merc, lon_lr_merc) = get_merc_bbox(max(tile[0] for tile in strava_tiles),
+                                                     max(tile[1] for tile in strava_tiles))
+    osm_data = overpass_request(lat_ul_merc + distance, lon_ul_merc - distance,
+                                lat_lr_merc - distance, lon_lr_merc + distance)
+
+    features_merc = project_features(*get_osm_features(osm_data))
+
+    for (x, y, strava_tile, data) in strava_tiles:
+        check_strava_tile(x, y, zoom, strava_tile, data, features_merc)
 
 
 # Parse command line arguments
@@ -388,7 +568,7 @@ parser.add_argument("-d", "--distance", type=int, default=35,
                     help="Maximum distance between Strava hot point and OSM way")
 parser.add_argument("-s", "--size", type=int, default=20,
                     help="Minimum size of Strava trace (in pixels)")
-parser.add_argument("-z", "--zoom", default=15,
+parser.add_argument("-z", "--zoom", type=int, default=15,
                     help="Strava zoom level (10-15)")
 parser.add_argument("-c", "--activity", default='run',
                     help="Strava activity (default=run)")
@@ -406,6 +586,10 @@ parser.add_argument('-x', '--x', type=int,
                     help="Strava Tile x coordinate")
 parser.add_argument('-y', '--y', type=int,
                     help="Strava Tile y coordinate")
+parser.add_argument('-j', '--jobs', type=int, default=8,
+                    help="Number of blocks of Strava tiles processed in parallel")
+parser.add_argument('--cache_size', type=int,
+                    help="Maximum size of the Strava tiles cache (in MB)")
 parser.add_argument('--debug', action='store_true',
                     help="Debug mode")
 
@@ -418,6 +602,11 @@ print_verbose("Maximum distance = ", distance)
 threshold = args.minlevel
 print_verbose("Threshold = ", threshold)
 zoom = args.zoom
+# Tables of the pseudo-Mercator coordinates of the tile edges, for get_merc_bbox
+(edges_x_merc, edges_y_merc) = get_merc_edges(zoom)
+# Number of Strava tiles on each side of a block sharing an Overpass request,
+# so that a block is never larger than a zoom 13 tile (about 5 km)
+block_size = 1 << max(0, zoom - 13)
 min_size = args.size
 print_verbose("Minimum size = ", min_size)
 activity = args.activity
@@ -430,15 +619,24 @@ if args.geojson is not None:
 else:
     geojson_file = sys.stdout
 
+# Open the index of the Strava tiles cache, and evict the least recently used tiles
+cache_index = None
+if args.cache_size is not None:
+    cache_index = open_cache_index()
+    evict_cache(args.cache_size * 1024 * 1024)
+
+# Load the tasks already processed from the tasks database, indexed by task name
+tasks = {}
 if tasks_db is not None:
-    # Create connection to "not_an_issue" database, and create a cursor
     con = sqlite3.connect(f"file:{tasks_db}?mode=ro", uri=True)
-    cur = con.cursor()
+    for row in con.execute("SELECT TaskName,TaskStatus,Mapper,TaskLink FROM tasks"):
+        tasks[row[0]] = row[1:]
+    con.close()
 
 if args.x is not None and args.y is not None:
     x = args.x
     y = args.y
-    check_strava_tile(None, x, y, zoom)
+    check_strava_block([(x, y)], zoom)
     exit(0)
 
 if args.x is not None or args.y is not None:
@@ -454,8 +652,8 @@ with open(args.area) as f:
     features = json.load(f)["features"]
 
 # NOTE: buffer(0) is a trick for fixing scenarios where polygons have overlapping coordinates
-polygon_area = GeometryCollection([shape(feature["geometry"]).buffer(0) for feature in features])
-bbox_area = polygon_area.bounds
+polygons_area = [shape(feature["geometry"]).buffer(0) for feature in features]
+bbox_area = GeometryCollection(polygons_area).bounds
 print_verbose("Area bounding box:", bbox_area)
 
 # Bounding box of area in Mercator projection
@@ -485,15 +683,39 @@ if args.offset is not None:
 else:
     step = 1
 
-for x in range(xul + offset_x, xlr, step):
-    if progress:
-        print(".", end='', flush=True)
-    for y in range(yul - offset_y, ylr, -step):
-        print_debug(x, y)
-        check_strava_tile(polygon_area, x, y, zoom)
-    if progress:
-        print("")
+(tiles_x, tiles_y) = (tiles.ravel() for tiles in np.meshgrid(np.arange(xul + offset_x, xlr, step),
+                                                              np.arange(yul - offset_y, ylr, -step),
+                                                              indexing='ij'))
+
+# Keep the Strava tiles whose center is in the area, with a vectorized point in polygon test
+(lat_center, lon_center) = num2deg_vec(tiles_x + 0.5, tiles_y + 0.5, zoom)
+in_area = np.zeros(len(tiles_x), dtype=bool)
+for polygon in polygons_area:
+    shapely.prepare(polygon)
+    in_area |= shapely.contains_xy(polygon, lon_center, lat_center)
+
+# Keep the other Strava tiles intersecting the area, with a single query of a spatial index
+others = np.flatnonzero(~in_area)
+(lat_ul, lon_ul) = num2deg_vec(tiles_x[others], tiles_y[others], zoom)
+(lat_lr, lon_lr) = num2deg_vec(tiles_x[others] + 1, tiles_y[others] + 1, zoom)
+polygons_strava = shapely.box(lon_ul, lat_lr, lon_lr, lat_ul)
+in_area[others[shapely.STRtree(polygons_area).query(polygons_strava, predicate='intersects')[0]]] = True
+
+# Group the Strava tiles in blocks sharing the same Overpass request
+blocks = {}
+for (x, y) in zip(tiles_x[in_area].tolist(), tiles_y[in_area].tolist()):
+    blocks.setdefault((x // block_size, y // block_size), []).append((x, y))
+
+# Process the blocks in parallel, as they are mostly waiting for the network
+with ThreadPoolExecutor(max_workers=args.jobs) as executor:
+    results = executor.map(check_strava_block, blocks.values(), [zoom] * len(blocks))
+    previous_block_x = None
+    for (block_x, _), _ in zip(blocks, results):
+        if progress and block_x != previous_block_x:
+            print(".", flush=True)
+        previous_block_x = block_x
 
 geojson_file.close()
-if tasks_db is not None:
-    con.close()
+if args.cache_size is not None:
+    evict_cache(args.cache_size * 1024 * 1024)
+    cache_index.close()